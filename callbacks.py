@@ -5,19 +5,108 @@ from __future__ import print_function
 
 import os
 import csv
+import threading
 
+import h5py
 import numpy as np
 import time
 import json
 import warnings
 
 from collections import deque, OrderedDict, Iterable
-from .utils.generic_utils import Progbar
 
 import keras
 from keras import backend as K
 
 
+class AsyncModelCheckpoint(keras.callbacks.ModelCheckpoint):
+    '''ModelCheckpoint with the HDF5 write moved off the training thread.
+    The stock callback blocks the start of the next epoch on a synchronous
+    h5py write every time the monitored metric improves. Here only the
+    weight snapshot is synchronous (the same device-to-host copies the
+    stock callback does anyway); the file write runs on a background
+    thread and overlaps the first batches of the next epoch.
+    Only weights are saved (save_weights_only is implied). The on-disk
+    layout matches Model.save_weights, so load_weights reads the files.
+    # Arguments
+        filepath: same template as ModelCheckpoint.
+    '''
+
+    def __init__(self, filepath, **kwargs):
+        kwargs['save_weights_only'] = True
+        super(AsyncModelCheckpoint, self).__init__(filepath, **kwargs)
+        self._thread = None
+
+    def _snapshot(self):
+        '''Copy the weights to host numpy arrays, grouped by layer.'''
+        layers = getattr(self.model, 'flattened_layers', self.model.layers)
+        snapshot = []
+        for layer in layers:
+            names = [w.name.encode('utf8') for w in layer.weights]
+            values = K.batch_get_value(layer.weights)
+            snapshot.append((layer.name.encode('utf8'), names, values))
+        return snapshot
+
+    @staticmethod
+    def _write(filepath, snapshot):
+        '''Write a snapshot in the Model.save_weights HDF5 layout.'''
+        f = h5py.File(filepath, 'w')
+        f.attrs['layer_names'] = [name for name, _, _ in snapshot]
+        for name, weight_names, weight_values in snapshot:
+            g = f.create_group(name)
+            g.attrs['weight_names'] = weight_names
+            for wname, wval in zip(weight_names, weight_values):
+                dset = g.create_dataset(wname, wval.shape, dtype=wval.dtype)
+                if wval.shape:
+                    dset[:] = wval
+                else:
+                    dset[()] = wval
+        f.flush()
+        f.close()
+        # Push the checkpoint out of the page cache before reporting done.
+        fd = os.open(filepath, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+
+    def _save_async(self, filepath):
+        # At most one write in flight: epochs are much longer than the
+        # write, so this join is a no-op except under pathological IO.
+        if self._thread is not None:
+            self._thread.join()
+        snapshot = self._snapshot()
+        self._thread = threading.Thread(target=self._write,
+                                        args=(filepath, snapshot))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_epoch_end(self, epoch, logs={}):
+        filepath = self.filepath.format(epoch=epoch, **logs)
+        if self.save_best_only:
+            current = logs.get(self.monitor)
+            if current is None:
+                warnings.warn('Can save best model only with %s available, '
+                              'skipping.' % (self.monitor), RuntimeWarning)
+                return
+            if not self.monitor_op(current, self.best):
+                if self.verbose > 0:
+                    print('Epoch %05d: %s did not improve' %
+                          (epoch, self.monitor))
+                return
+            if self.verbose > 0:
+                print('Epoch %05d: %s improved from %0.5f to %0.5f,'
+                      ' saving model to %s'
+                      % (epoch, self.monitor, self.best, current, filepath))
+            self.best = current
+        elif self.verbose > 0:
+            print('Epoch %05d: saving model to %s' % (epoch, filepath))
+        self._save_async(filepath)
+
+    def on_train_end(self, logs={}):
+        # Make sure the last checkpoint hit the disk before returning.
+        if self._thread is not None:
+            self._thread.join()
+
+
 class TensorBoard(keras.callbacks.Callback):
     ''' Tensorboard basic visualizations.
     This callback writes a log for TensorBoard, which allows
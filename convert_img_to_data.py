@@ -510,6 +510,17 @@ def save_np_data(path, data):
     np.savez(filename, **data)
 
 
+def save_np_data_nchw(path, data):
+    """Save data as npz file with images packed as contiguous planar
+    NCHW float16 — the layout cuDNN conv kernels prefer for
+    channels-first training, consumable without a reformat pass.
+    """
+    data = dict(data)
+    data['images'] = np.moveaxis(data['images'], -1, -3).astype(np.float16)
+    filename = path + 'dataset_nchw.npz'
+    np.savez(filename, **data)
+
+
 # ============================================================================
 # Load / Save data: HDF5 file.
 # ============================================================================
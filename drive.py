@@ -1,42 +1,116 @@
 import argparse
 import base64
 import json
+import math
 
+import cv2
+import numba
 import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
 import time
-from PIL import Image
-from PIL import ImageOps
 from flask import Flask, render_template
-from io import BytesIO
 
-from keras.models import model_from_json
+from keras import backend as K
+from keras.models import model_from_json, load_model
+
+from model import DenseDropout, InputNormalize, WeightDecayAdam
+
+# Custom objects referenced by the saved models: the custom layers, plus
+# the optimizer recorded in model.h5's training config.
+CUSTOM_OBJECTS = {'DenseDropout': DenseDropout,
+                  'InputNormalize': InputNormalize,
+                  'WeightDecayAdam': WeightDecayAdam}
 from keras.preprocessing.image import ImageDataGenerator, array_to_img, img_to_array
 
 from skimage import color
 
+# libjpeg-turbo decoding: ~3x faster than PIL on 320x160 frames. Fall back
+# on OpenCV when PyTurboJPEG is not installed.
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    jpeg = TurboJPEG()
+except ImportError:
+    jpeg = None
+
 sio = socketio.Server()
 app = Flask(__name__)
 model = None
+infer = None
 prev_image_array = None
 
-
-def image_preprocessing(img):
-    img = img.astype(np.float32) / 255.
+# Rad -> simulator steering angle scaling. Constant: hoisted out of the
+# telemetry callback.
+ANGLE_FACTOR = 180. / 25. / math.pi * 1.5
+
+# Pre-processed image shape (after cropping the top CROP_TOP rows).
+CROP_TOP = 55
+IMG_SHAPE = (105, 320, 3)
+# Pre-allocated input buffer: reused on every frame to avoid re-allocating
+# (and re-copying) a full image several times per control tick.
+transformed_image_array = np.empty((1, ) + IMG_SHAPE, dtype=np.float32)
+
+# Input scale applied while preprocessing: 1 for models that normalize
+# raw 0-255 inputs themselves (InputNormalize first layer, TRT engines),
+# 1/255 for legacy checkpoints trained on /255-scaled frames. Set per
+# model at load time below.
+INPUT_SCALE = 1.0
+
+
+def jpeg_decode(raw):
+    """Decode a raw JPEG buffer to an RGB uint8 array."""
+    if jpeg is not None:
+        return jpeg.decode(raw, pixel_format=TJPF_RGB)
+    img = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+@numba.jit(nopython=True, parallel=True, fastmath=True, cache=True)
+def _crop_cast(src, dst, scale):
+    """Fused crop + uint8 to float32 cast + rescale: one read of uint8,
+    one write of float32, no intermediates."""
+    rows, cols, channels = dst.shape
+    s = np.float32(scale)
+    for y in numba.prange(rows):
+        for x in range(cols):
+            for c in range(channels):
+                dst[y, x, c] = src[y + CROP_TOP, x, c] * s
+
+
+def make_predict_fn(model):
+    """Compile the forward pass once with the backend: a direct graph call
+    per frame, without predict()'s batching/callback machinery. The
+    learning phase is pinned to 0 (inference: BN/Dropout frozen).
+    """
+    f = K.function([model.input, K.learning_phase()], [model.output])
+    return lambda x: f([x, 0])[0]
+
+
+def model_input_scale(model):
+    """Input scale a loaded Keras model expects: 1 when it normalizes raw
+    0-255 inputs itself, 1/255 for legacy checkpoints whose input
+    BatchNormalization was trained on /255-scaled frames."""
+    if isinstance(model.layers[0], InputNormalize):
+        return 1.0
+    return 1. / 255.
+
+
+def image_preprocessing(img, out=None):
+    # Cut bottom and top, cast and rescale to the loaded model's input
+    # range in a single pass.
+    if out is None:
+        out = np.empty(IMG_SHAPE, dtype=np.float32)
+    _crop_cast(img, out, INPUT_SCALE)
     # img = 2. * img - 1.
 
-    # Cut bottom and top.
-    img = img[55:, :, :]
-
     # img = color.rgb2hsv(img)
     # img = 2 * img - 1
 
     # out = cv2.resize(out, (IMG_SHAPE[1], IMG_SHAPE[0]), interpolation=cv2.INTER_LANCZOS4)
     # out = out[34:-10, :, :]
     # out = cv2.cvtColor(out, cv2.COLOR_BGR2HLS)
-    return img
+    return out
 
 @sio.on('telemetry')
 def telemetry(sid, data):
@@ -48,21 +122,19 @@ def telemetry(sid, data):
     speed = data["speed"]
     # The current image from the center camera of the car
     imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    image_array = np.asarray(image)
+    image_array = jpeg_decode(base64.b64decode(imgString))
 
-    image_array = image_preprocessing(image_array)
-    transformed_image_array = image_array[None, :, :, :]
+    # Pre-process straight into the pre-allocated prediction buffer.
+    image_preprocessing(image_array, out=transformed_image_array[0])
 
     # This model currently assumes that the features of the model are just the images. Feel free to change this.
-    angle_factor = 180. / 25. / np.pi * 1.5
-    steering_angle = float(model.predict(transformed_image_array, batch_size=1)) * angle_factor
+    steering_angle = infer(transformed_image_array).item() * ANGLE_FACTOR
     # The driving model currently just outputs a constant throttle. Feel free to edit this.
     throttle = 0.5
 
     print('Steering: %.3f | Throttle: %.3f | Factor: %.3f' % (steering_angle,
                                                               throttle,
-                                                              angle_factor))
+                                                              ANGLE_FACTOR))
     send_control(steering_angle, throttle)
 
 
@@ -89,15 +161,43 @@ if __name__ == '__main__':
     path = args.model
     root = path.split('.')[0]
 
-    # Load model description
-    jpath = root + '.json'
-    with open(jpath, 'r') as jfile:
-        model = model_from_json(json.load(jfile))
-
-    # Load model weights.
-    model.compile("adam", "mse")
-    wpath = args.model.replace('json', 'h5')
-    model.load_weights(wpath)
+    if path.endswith('.trt'):
+        # Serialized TensorRT engine (see trt_engine.py). Engines are
+        # exported from new-style models that normalize raw 0-255 inputs
+        # themselves, so INPUT_SCALE stays 1.
+        from trt_engine import TRTModel
+        model = TRTModel(path)
+        infer = model.predict
+    elif path.endswith('.h5'):
+        # Single-file model (architecture + weights saved together by
+        # train_model): one load call, no JSON re-parse.
+        model = load_model(path, custom_objects=CUSTOM_OBJECTS)
+        infer = make_predict_fn(model)
+        INPUT_SCALE = model_input_scale(model)
+    else:
+        # Load model description
+        jpath = root + '.json'
+        with open(jpath, 'r') as jfile:
+            spec = json.load(jfile)
+            # Old checkpoints store the architecture as a JSON-encoded
+            # string, newer ones as the pretty-printed dict.
+            if not isinstance(spec, str):
+                spec = json.dumps(spec)
+            model = model_from_json(spec, custom_objects=CUSTOM_OBJECTS)
+
+        # Load model weights.
+        model.compile("adam", "mse")
+        wpath = args.model.replace('json', 'h5')
+        model.load_weights(wpath)
+        infer = make_predict_fn(model)
+        INPUT_SCALE = model_input_scale(model)
+
+    # Warm up the JIT-compiled preprocessing kernel and the prediction
+    # graph before serving, so the first simulator frame does not pay the
+    # compile / trace cost inside the control loop.
+    image_preprocessing(np.zeros((160, 320, 3), dtype=np.uint8),
+                        out=transformed_image_array[0])
+    infer(transformed_image_array)
 
     # wrap Flask application with engineio's middleware
     app = socketio.Middleware(sio, app)
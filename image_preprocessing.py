@@ -7,15 +7,21 @@ from __future__ import print_function
 
 import os
 import re
+import atexit
 
+import cv2
 import numpy as np
 from scipy import linalg
 import scipy.ndimage as ndi
-from skimage import color
 import random
 
 from six.moves import range
 import threading
+import multiprocessing as mp
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 from keras import backend as K
 
@@ -64,11 +70,9 @@ def adjust_brightness(image, delta):
     For regular images, `delta` should be in the range `[0,1)`, as it is
     added to the image where pixel values are in the `[0,1)` range.
     """
-    out = np.zeros_like(image)
-    for i in range(3):
-        out[:, :, i] = image[:, :, i] + delta
-    out = np.clip(out, 0.0, 1.0)
-    return out
+    if np.ndim(delta) == 2:
+        delta = delta[:, :, np.newaxis]
+    return np.clip(image + delta, 0.0, 1.0)
 
 
 def adjust_contrast(image, contrast_factor):
@@ -78,25 +82,26 @@ def adjust_contrast(image, contrast_factor):
     channel and then adjusts each component `x` of each pixel to
     `(x - mean) * contrast_factor + mean`.
     """
-    out = np.zeros_like(image)
-    for i in range(3):
-        m = np.mean(image[:, :, i])
-        out[:, :, i] = (image[:, :, i] - m) * np.abs(contrast_factor) + m
-    out = np.clip(out, 0.0, 1.0)
-    return out
+    contrast_factor = np.abs(contrast_factor)
+    if np.ndim(contrast_factor) == 2:
+        contrast_factor = contrast_factor[:, :, np.newaxis]
+    m = np.mean(image, axis=(0, 1), keepdims=True)
+    return np.clip((image - m) * contrast_factor + m, 0.0, 1.0)
 
 
 def adjust_saturation_hue(image, saturation_factor, hue_delta):
     """Adjust saturation and hue of an RGB image.
     Converts to HSV, add an offset to the saturation channel and
-    converts back to RGB.
+    converts back to RGB. Uses OpenCV for the color conversions:
+    on float32 images, H is in [0, 360) and S, V in [0, 1].
     """
-    img_hsv = color.rgb2hsv(image)
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    img_hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
     # Adjust saturation and hue channels.
     img_hsv[:, :, 1] = np.clip(img_hsv[:, :, 1] * np.abs(saturation_factor), 0.0, 1.0)
-    img_hsv[:, :, 0] = np.mod(img_hsv[:, :, 0] + 1. + hue_delta, 1.0)
+    img_hsv[:, :, 0] = np.mod(img_hsv[:, :, 0] + 360. * (1. + hue_delta), 360.0)
     # Back to RGB mod.
-    return color.hsv2rgb(img_hsv)
+    return cv2.cvtColor(img_hsv, cv2.COLOR_HSV2RGB)
 
 
 # ============================================================================
@@ -363,13 +368,13 @@ class ImageDataGenerator(object):
     def flow(self, X, y=None,
              batch_size=32,
              sample_weight=None,
-             shuffle=True, seed=None,
+             shuffle=True, seed=None, drop_remainder=False,
              save_to_dir=None, save_prefix='', save_format='jpeg'):
         return NumpyArrayIterator(
             X, y, self,
             batch_size=batch_size,
             sample_weight=sample_weight,
-            shuffle=shuffle, seed=seed,
+            shuffle=shuffle, seed=seed, drop_remainder=drop_remainder,
             dim_ordering=self.dim_ordering,
             save_to_dir=save_to_dir, save_prefix=save_prefix, save_format=save_format)
 
@@ -421,9 +426,6 @@ class ImageDataGenerator(object):
             theta = np.pi / 180 * np.random.uniform(-self.rotation_range, self.rotation_range)
         else:
             theta = 0
-        rotation_matrix = np.array([[np.cos(theta), -np.sin(theta), 0],
-                                    [np.sin(theta), np.cos(theta), 0],
-                                    [0, 0, 1]])
         if self.height_shift_range:
             tx = np.random.uniform(-self.height_shift_range, self.height_shift_range) * x.shape[img_row_index]
         else:
@@ -434,31 +436,37 @@ class ImageDataGenerator(object):
         else:
             ty = 0
 
-        translation_matrix = np.array([[1, 0, tx],
-                                       [0, 1, ty],
-                                       [0, 0, 1]])
         if self.shear_range:
             shear = np.random.uniform(-self.shear_range, self.shear_range)
         else:
             shear = 0
-        shear_matrix = np.array([[1, -np.sin(shear), 0],
-                                 [0, np.cos(shear), 0],
-                                 [0, 0, 1]])
-
         if self.zoom_range[0] == 1 and self.zoom_range[1] == 1:
             zx, zy = 1, 1
         else:
             zx, zy = np.random.uniform(self.zoom_range[0], self.zoom_range[1], 2)
-        zoom_matrix = np.array([[zx, 0, 0],
-                                [0, zy, 0],
-                                [0, 0, 1]])
 
-        transform_matrix = np.dot(np.dot(np.dot(rotation_matrix, translation_matrix), shear_matrix), zoom_matrix)
+        # Only resample when there is an actual geometric transform: the
+        # per-channel ndimage warp is by far the most expensive step of the
+        # generator, and a pure waste when it is the identity.
+        if theta != 0 or tx != 0 or ty != 0 or shear != 0 or zx != 1 or zy != 1:
+            rotation_matrix = np.array([[np.cos(theta), -np.sin(theta), 0],
+                                        [np.sin(theta), np.cos(theta), 0],
+                                        [0, 0, 1]])
+            translation_matrix = np.array([[1, 0, tx],
+                                           [0, 1, ty],
+                                           [0, 0, 1]])
+            shear_matrix = np.array([[1, -np.sin(shear), 0],
+                                     [0, np.cos(shear), 0],
+                                     [0, 0, 1]])
+            zoom_matrix = np.array([[zx, 0, 0],
+                                    [0, zy, 0],
+                                    [0, 0, 1]])
+            transform_matrix = np.dot(np.dot(np.dot(rotation_matrix, translation_matrix), shear_matrix), zoom_matrix)
 
-        h, w = x.shape[img_row_index], x.shape[img_col_index]
-        transform_matrix = transform_matrix_offset_center(transform_matrix, h, w)
-        x = apply_transform(x, transform_matrix, img_channel_index,
-                            fill_mode=self.fill_mode, cval=self.cval)
+            h, w = x.shape[img_row_index], x.shape[img_col_index]
+            transform_matrix = transform_matrix_offset_center(transform_matrix, h, w)
+            x = apply_transform(x, transform_matrix, img_channel_index,
+                                fill_mode=self.fill_mode, cval=self.cval)
         if self.channel_shift_range != 0:
             x = random_channel_shift(x, self.channel_shift_range, img_channel_index)
 
@@ -541,12 +549,105 @@ class ImageDataGenerator(object):
             self.principal_components = np.dot(np.dot(U, np.diag(1. / np.sqrt(S + 10e-7))), U.T)
 
 
+def shm_flow(flow_factory, nb_worker=8, pool_size=32):
+    """Prefetch augmented batches from worker processes through a pool of
+    shared-memory slots.
+
+    With `pickle_safe=True` every batch is serialized through pickle on
+    its way back to the main process. Here each worker materializes its
+    batches straight into a pre-allocated shared-memory slot and only the
+    slot index travels through the queue; the main process copies the
+    batch out (one memcpy) and recycles the slot.
+
+    Params:
+      flow_factory: callable(worker_id) -> batch iterator; each worker
+        builds its own iterator, seeded by its id.
+      nb_worker: number of producer processes.
+      pool_size: number of shared-memory batch slots.
+    Return:
+      Generator yielding (batch_x, batch_y, batch_w), for fit_generator
+      with nb_worker=1 / pickle_safe=False.
+    """
+    if shared_memory is None:
+        raise RuntimeError('multiprocessing.shared_memory not available.')
+
+    # Probe one batch to size the slots (full batch shapes and dtypes).
+    probe = flow_factory(0)
+    arrays = next(probe)
+    del probe
+    shapes = [a.shape for a in arrays]
+    dtypes = [a.dtype for a in arrays]
+    strides = [a.nbytes for a in arrays]
+    slot_bytes = sum(strides)
+
+    slots = [shared_memory.SharedMemory(create=True, size=slot_bytes)
+             for _ in range(pool_size)]
+    free_q = mp.Queue()
+    for i in range(pool_size):
+        free_q.put(i)
+    ready_q = mp.Queue()
+
+    def slot_views(slot, n):
+        views = []
+        offset = 0
+        for shape, dtype, stride in zip(shapes, dtypes, strides):
+            views.append(np.ndarray((n, ) + shape[1:], dtype=dtype,
+                                    buffer=slot.buf, offset=offset))
+            offset += stride
+        return views
+
+    def produce(worker_id):
+        for batch in flow_factory(worker_id):
+            n = batch[0].shape[0]
+            i = free_q.get()
+            for view, arr in zip(slot_views(slots[i], n), batch):
+                view[...] = arr
+            ready_q.put((i, n))
+
+    procs = []
+    for worker_id in range(nb_worker):
+        p = mp.Process(target=produce, args=(worker_id, ))
+        p.daemon = True
+        p.start()
+        procs.append(p)
+
+    def cleanup():
+        # Idempotent: runs from the generator's finally and from atexit.
+        # Producers go first, so no worker touches an unlinked slot.
+        while procs:
+            p = procs.pop()
+            p.terminate()
+            p.join()
+        while slots:
+            slot = slots.pop()
+            slot.close()
+            slot.unlink()
+    # fit_generator never exhausts the generator, so also reclaim the
+    # /dev/shm segments when the process exits without closing it.
+    atexit.register(cleanup)
+
+    try:
+        while 1:
+            i, n = ready_q.get()
+            batch = tuple(view.copy() for view in slot_views(slots[i], n))
+            free_q.put(i)
+            yield batch
+    finally:
+        cleanup()
+
+
 class Iterator(object):
 
-    def __init__(self, N, batch_size, shuffle, seed):
+    def __init__(self, N, batch_size, shuffle, seed, drop_remainder=False):
+        if drop_remainder and N < batch_size:
+            # Every batch would be a dropped tail: _flow_index would spin
+            # forever without yielding.
+            raise Exception('drop_remainder needs at least one full batch. '
+                            'Found: N = %d < batch_size = %d' % (N, batch_size))
         self.N = N
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.drop_remainder = drop_remainder
         self.batch_index = 0
         self.total_batches_seen = 0
         self.lock = threading.Lock()
@@ -571,6 +672,11 @@ class Iterator(object):
                 current_batch_size = batch_size
                 self.batch_index += 1
             else:
+                if self.drop_remainder:
+                    # Skip the ragged tail batch so every batch keeps the
+                    # same static shape: reshuffle and start a new pass.
+                    self.batch_index = 0
+                    continue
                 current_batch_size = N - current_index
                 self.batch_index = 0
             self.total_batches_seen += 1
@@ -590,7 +696,7 @@ class NumpyArrayIterator(Iterator):
 
     def __init__(self, X, y, image_data_generator,
                  batch_size=32, sample_weight=None,
-                 shuffle=False, seed=None,
+                 shuffle=False, seed=None, drop_remainder=False,
                  dim_ordering='default',
                  save_to_dir=None, save_prefix='', save_format='jpeg'):
         if y is not None and len(X) != len(y):
@@ -607,7 +713,8 @@ class NumpyArrayIterator(Iterator):
         self.save_prefix = save_prefix
         self.save_format = save_format
         self.sample_weight = np.ones((X.shape[0], ), dtype=np.float32) if sample_weight is None else sample_weight
-        super(NumpyArrayIterator, self).__init__(X.shape[0], batch_size, shuffle, seed)
+        super(NumpyArrayIterator, self).__init__(X.shape[0], batch_size, shuffle, seed,
+                                                 drop_remainder=drop_remainder)
 
     def next(self):
         # for python 2.x.
@@ -617,15 +724,23 @@ class NumpyArrayIterator(Iterator):
         with self.lock:
             index_array, current_index, current_batch_size = next(self.index_generator)
         # The transformation of images is not under thread lock so it can be done in parallel
-        batch_x = np.zeros(tuple([current_batch_size] + list(self.X.shape)[1:]))
+        # Batches keep the dtype of the dataset: uint8 images stay uint8
+        # until the model's cast layer, so queued batches stay small.
+        batch_x = np.zeros(tuple([current_batch_size] + list(self.X.shape)[1:]),
+                           dtype=self.X.dtype)
         batch_y = self.y[index_array]
         batch_w = self.sample_weight[index_array]
 
+        uint8_input = batch_x.dtype == np.uint8
         for i, j in enumerate(index_array):
-            x = self.X[j]
-            x, y = self.image_data_generator.random_transform(x.astype('float32'),
-                                                              self.y[j])
+            x = self.X[j].astype('float32')
+            # Random transforms operate on [0, 1] images.
+            if uint8_input:
+                x /= 255.
+            x, y = self.image_data_generator.random_transform(x, self.y[j])
             x = self.image_data_generator.standardize(x)
+            if uint8_input:
+                x *= 255.
             batch_x[i] = x
             batch_y[i] = y
 
@@ -1,5 +1,9 @@
 """Keras Behavioral Cloning model.
 """
+import os
+import zipfile
+import multiprocessing
+
 import h5py
 import json
 
@@ -7,19 +11,32 @@ import cv2
 import math
 import numpy as np
 
+# cuDNN autotune: all conv shapes are fixed for the whole run, so the
+# one-time exhaustive search locks in the best kernel per layer; the
+# larger workspace lets it pick the non-fused Winograd algorithms.
+# Must be set before TensorFlow is first imported (below, via Keras).
+os.environ.setdefault('TF_CUDNN_USE_AUTOTUNE', '1')
+os.environ.setdefault('TF_CUDNN_WORKSPACE_LIMIT_IN_MB', '4096')
+# TF32 on Ampere-class GPUs: runs the fp32 convolutions on Tensor Cores
+# with no loss-scaling machinery. Ignored by the driver on older parts.
+os.environ.setdefault('NVIDIA_TF32_OVERRIDE', '1')
+
 import keras
-from keras.models import Sequential
+from keras import backend as K
+from keras.models import Sequential, Model
+from keras.engine.topology import Layer
 
+from keras.layers import Input, merge
 from keras.layers import Dense, Dropout, Activation, Flatten, Lambda
 from keras.layers import Convolution2D, MaxPooling2D, AveragePooling2D
 from keras.layers.normalization import BatchNormalization
-from keras.regularizers import l1, l2
 
 from keras.optimizers import SGD
 from keras.utils import np_utils
 from keras.utils.io_utils import HDF5Matrix
 
-from image_preprocessing import ImageDataGenerator
+from callbacks import AsyncModelCheckpoint
+from image_preprocessing import ImageDataGenerator, shm_flow, shared_memory
 
 
 # General parameters.
@@ -33,8 +50,35 @@ ANGLE_WEIGHT = 10.0
 L2_WEIGHT = 0.00001
 SEED = 4242
 
-FINE_TUNE = 'logs/model.h5'
-# FINE_TUNE = None
+# Generator processes: a queue deep enough to absorb the jitter of the
+# color augmentations. Eight workers are plenty once batches stop going
+# through pickle.
+NB_WORKER = min(8, multiprocessing.cpu_count())
+MAX_Q_SIZE = 64
+
+# Ship augmented batches through shared memory instead of pickling them
+# between the worker processes and the trainer.
+SHM_PREFETCH = shared_memory is not None
+
+# XLA JIT auto-clustering: fuses the BN / activation / optimizer
+# elementwise chains into single kernels.
+XLA_JIT = True
+
+# Data-parallel training over local GPUs (1 = single device). The batch
+# size and learning rate are both scaled linearly by this factor.
+NB_GPUS = 1
+
+# Half-precision training: 'float16' on TensorCore-class GPUs. The loss
+# is scaled by a constant to keep small gradients from flushing to zero
+# in fp16; Adam's update is invariant to that scale, so no unscaling.
+FLOATX = 'float32'
+LOSS_SCALE = 128.
+
+# Checkpoint to fine-tune from. Must match the current architecture:
+# older checkpoints (54-filter convs, PReLU head, standalone Dropout,
+# input BatchNormalization) no longer load, so this defaults off.
+# FINE_TUNE = 'logs/model.h5'
+FINE_TUNE = None
 
 # Color preprocessing.
 BRIGHTNESS_DELTA = 80. / 255.
@@ -49,6 +93,18 @@ IMG_ROWS, IMG_COLS = 160, 320
 IMG_ROWS, IMG_COLS = 105, 320
 IMG_CHANNELS = 3
 
+# Data layout: 'th' (NCHW) feeds cuDNN's fast conv path directly, with no
+# transpose kernels around each conv. The color augmentations assume
+# channels-last, so keep 'tf' when they are enabled.
+DIM_ORDERING = 'tf'
+
+# Memory-map the dataset instead of loading it into RAM. The first run
+# extracts the compressed .npz datasets into the uncompressed .npy cache
+# below; later runs open it in milliseconds instead of re-inflating zlib.
+MMAP_DATA = True
+MMAP_IMAGES = './data/images_cache.npy'
+MMAP_ANGLE = './data/angle_cache.npy'
+
 # Datasets to use
 DATASETS = [
             ('./data/q3_recover_left/dataset.npz', 'angle_med6'),
@@ -63,52 +119,103 @@ DATASETS = [
 # ============================================================================
 # Load data
 # ============================================================================
-def np_shuffle_pair(x, y):
-    rng_state = np.random.get_state()
-    np.random.shuffle(x)
-    np.random.set_state(rng_state)
-    np.random.shuffle(y)
+def npz_member_shape(path, name='images'):
+    """Shape of one array in a .npz, read from the npy header of the zip
+    member. np.load ignores mmap_mode on .npz files, so asking the loaded
+    array for its shape inflates the whole compressed member; the header
+    sits uncompressed-cheap at the front of the entry.
+    """
+    with zipfile.ZipFile(path) as zf:
+        with zf.open(name + '.npy') as f:
+            np.lib.format.read_magic(f)
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+    return shape
+
+
+def build_mmap_cache(datasets):
+    """One-time extraction of the .npz datasets into a pair of uncompressed
+    .npy files, pre-shuffled on disk so the memory-mapped load can split
+    train / validation with plain slices.
+    """
+    shapes = [npz_member_shape(path) for path, _ in datasets]
+    nb_samples = sum(s[0] for s in shapes)
+
+    np.random.seed(SEED)
+    perm = np.random.permutation(nb_samples)
+
+    images = np.lib.format.open_memmap(
+        MMAP_IMAGES, mode='w+', dtype=np.uint8,
+        shape=(nb_samples, ) + shapes[0][1:])
+    angle = np.empty((nb_samples, ), dtype=np.float32)
+    offset = 0
+    for path, angle_key in datasets:
+        print('Caching dataset:', path)
+        data = np.load(path)
+        n = data['images'].shape[0]
+        idx = perm[offset:offset+n]
+        images[idx] = data['images']
+        angle[idx] = data[angle_key]
+        offset += n
+        del data
+    images.flush()
+    del images
+    np.save(MMAP_ANGLE, angle)
 
 
-def load_npz(datasets, split=0.9):
-    """Load data from Numpy .npz files and rescale images to [0, 1].
+def load_npz(datasets, split=0.9, mmap=MMAP_DATA):
+    """Load data from Numpy .npz files. Images are kept as uint8: the
+    [0, 1] rescaling is done on GPU by the first model layer, which keeps
+    host RAM and host-to-device transfers 4x smaller than float32.
 
     Args:
       filenames: List of dataset: (filename, angle_key).
       split: Split proportion between train / validation datasets.
+      mmap: Memory-map the images from an uncompressed .npy cache
+        (built on first run) instead of loading them into RAM.
     Return:
       (X_train, y_train, X_test, y_test) Numpy arrays.
     """
-    # Load data from numpy files.
-    images = None
-    angle = None
-    for path, angle_key in datasets:
-        print('Loading dataset:', path)
-        data = np.load(path)
-        if images is None:
-            images = data['images'].astype(np.float16)
-            angle = data[angle_key]
-        else:
-            # Resize images and append data.
-            shape = images.shape
-            new_shape = (shape[0] + data['images'].shape[0], *shape[1:])
-            images.resize(new_shape)
-            # Image and angle...
-            images[shape[0]:, ...] = data['images']
-            angle = np.append(angle, data[angle_key], axis=0)
-
-        del data
-
-    # Images and angle pre-processing.
-    images /= 255.
+    if mmap:
+        # OS page cache manages residency: host RAM stays constant however
+        # many datasets are listed. The cache is already shuffled on disk,
+        # so slicing below gives a random train / validation split.
+        if not os.path.exists(MMAP_IMAGES):
+            build_mmap_cache(datasets)
+        images = np.load(MMAP_IMAGES, mmap_mode='r')
+        angle = np.load(MMAP_ANGLE)
+    else:
+        # First pass: sample counts only, to size the buffers, from the
+        # npy headers (no decompression).
+        shapes = [npz_member_shape(path) for path, _ in datasets]
+        nb_samples = sum(s[0] for s in shapes)
+
+        # Pre-allocate once and fill by slice: load time stays linear in
+        # the total number of bytes, with no transient old+new copy.
+        images = np.empty((nb_samples, ) + shapes[0][1:], dtype=np.uint8)
+        angle = np.empty((nb_samples, ), dtype=np.float32)
+        offset = 0
+        for path, angle_key in datasets:
+            print('Loading dataset:', path)
+            data = np.load(path)
+            n = data['images'].shape[0]
+            images[offset:offset+n] = data['images']
+            angle[offset:offset+n] = data[angle_key]
+            offset += n
+            del data
+
+        # Random shuffling of the dataset: one permutation applied as a
+        # fancy index (a single sequential write per array) instead of two
+        # in-place Fisher-Yates passes over the full images.
+        np.random.seed(SEED)
+        perm = np.random.permutation(images.shape[0])
+        images = images[perm]
+        angle = angle[perm]
+
+    # Images stay uint8: rescaling is the model's first Lambda layer.
     # delta = 6
     # angle = angle[delta:]
     # angle = np.lib.pad(angle, ((0, delta)), 'symmetric')
 
-    # Random shuffling of the dataset (in-place)
-    np.random.seed(SEED)
-    np_shuffle_pair(images, angle)
-
     # Split datasets.
     if split < 1.0:
         idx = int(images.shape[0] * split)
@@ -149,136 +256,284 @@ def save_hyperparameters(ckpt_path):
 # ============================================================================
 # Model and training
 # ============================================================================
-def cnn_model(shape):
+class InputNormalize(Layer):
+    """Cast uint8 inputs to floatx and normalize with fixed constants.
+
+    Plays the input role the old input BatchNormalization had, but with
+    constants baked at build time instead of learned scales. The mean and
+    std are stored as plain lists in the layer config, so the model round
+    trips through to_json / from_config (a Lambda closing over numpy
+    arrays does not serialize in this Keras generation).
+    """
+    def __init__(self, mean=127.5, std=127.5, **kwargs):
+        super(InputNormalize, self).__init__(**kwargs)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.inv_std = (1. / self.std).astype(np.float32)
+
+    def call(self, x, mask=None):
+        return (K.cast(x, K.floatx()) - self.mean) * self.inv_std
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super(InputNormalize, self).get_config()
+        config['mean'] = self.mean.tolist()
+        config['std'] = self.std.tolist()
+        return config
+
+
+class DenseDropout(Dense):
+    """Dense layer with the dropout mask applied to its input in-layer.
+
+    Equivalent to Dropout(drop_rate) followed by Dense, but a separate
+    Dropout layer is a full read + write of the activation tensor in its
+    own elementwise kernel. Generating the mask inside the layer call
+    keeps it in the same graph region as the GEMM, where the XLA
+    auto-clusters fuse the mask multiply into the matmul operand read.
+    Identity outside the training phase, like Dropout.
+    """
+    def __init__(self, output_dim, drop_rate=0., **kwargs):
+        super(DenseDropout, self).__init__(output_dim, **kwargs)
+        self.drop_rate = drop_rate
+        self.uses_learning_phase = 0. < drop_rate < 1.
+
+    def call(self, x, mask=None):
+        if 0. < self.drop_rate < 1.:
+            x = K.in_train_phase(K.dropout(x, self.drop_rate), x)
+        return super(DenseDropout, self).call(x, mask)
+
+    def get_config(self):
+        config = super(DenseDropout, self).get_config()
+        config['drop_rate'] = self.drop_rate
+        return config
+
+
+def cnn_model(shape, mean=127.5, std=127.5):
     """Create the model learning the behavioral cloning from driving data.
     Inspired by NVIDIA paper on this topic.
+
+    Params:
+      shape: Input image shape.
+      mean, std: Input normalization constants (scalars or per-channel
+        arrays), typically the training-set statistics. Defaults map
+        uint8 inputs to [-1, 1].
     """
     model = Sequential()
-
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.9999, input_shape=shape))
+    # Channel axis to normalize over: first for 'th', last for 'tf'.
+    bn_axis = 1 if DIM_ORDERING == 'th' else -1
+
+    # Inputs are uint8: cast + normalize on GPU with fixed constants.
+    # This replaces the old input BatchNormalization, which only learned
+    # a per-channel scale/shift at the price of an extra full memory pass
+    # over the image on every forward/backward step.
+    model.add(InputNormalize(mean=mean, std=std, input_shape=shape))
     # First 5x5 convolutions layers.
     model.add(Convolution2D(24, 5, 5,
                             subsample=(2, 2),
-                            W_regularizer=l2(L2_WEIGHT),
                             # init='normal',
                             # input_shape=shape,
                             bias=False,
-                            border_mode='valid'))
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
+                            border_mode='valid',
+                            dim_ordering=DIM_ORDERING))
+    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999,
+                                 axis=bn_axis))
     model.add(Activation('relu'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2), border_mode='same'))
     print('Layer 1: ', model.layers[-1].output_shape)
 
     model.add(Convolution2D(36, 5, 5,
                             subsample=(2, 2),
-                            W_regularizer=l2(L2_WEIGHT),
                             # init='normal',
                             bias=False,
-                            border_mode='valid'))
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
+                            border_mode='valid',
+                            dim_ordering=DIM_ORDERING))
+    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999,
+                                 axis=bn_axis))
     model.add(Activation('relu'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2), border_mode='same'))
     print('Layer 2: ', model.layers[-1].output_shape)
 
-    # model.add(Convolution2D(48, 5, 5,
-    #                         subsample=(2, 2),
-    #                         # init='normal',
-    #                         border_mode='valid'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(Activation('relu'))
-    # model.add(MaxPooling2D(pool_size=(3, 3), strides=None, border_mode='valid'))
-    # print('Layer 3: ', model.layers[-1].output_shape)
-
-    model.add(Convolution2D(54, 5, 5,
+    # 56 filters: multiple of 8 for Tensor-Core tile alignment.
+    model.add(Convolution2D(56, 5, 5,
                             subsample=(2, 2),
                             # init='normal',
-                            W_regularizer=l2(L2_WEIGHT),
                             bias=False,
-                            border_mode='valid'))
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
+                            border_mode='valid',
+                            dim_ordering=DIM_ORDERING))
+    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999,
+                                 axis=bn_axis))
     model.add(Activation('relu'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2), border_mode='same'))
 
     print('Layer 3: ', model.layers[-1].output_shape)
 
-    model.add(Convolution2D(54, 5, 5,
+    model.add(Convolution2D(56, 5, 5,
                             # subsample=(2, 2),
                             # init='normal',
-                            W_regularizer=l2(L2_WEIGHT),
                             bias=False,
-                            border_mode='valid'))
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
+                            border_mode='valid',
+                            dim_ordering=DIM_ORDERING))
+    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999,
+                                 axis=bn_axis))
     model.add(Activation('relu'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
     print('Layer 3b: ', model.layers[-1].output_shape)
 
     # 3x3 Convolutions.
     model.add(Convolution2D(64, 3, 3,
                             # init='normal',
-                            W_regularizer=l2(L2_WEIGHT),
                             bias=False,
-                            border_mode='valid'))
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
+                            border_mode='valid',
+                            dim_ordering=DIM_ORDERING))
+    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999,
+                                 axis=bn_axis))
     model.add(Activation('relu'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
     print('Layer 4: ', model.layers[-1].output_shape)
 
     model.add(Convolution2D(80, 3, 3,
                             # init='normal',
-                            W_regularizer=l2(L2_WEIGHT),
                             bias=False,
-                            border_mode='valid'))
-    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
+                            border_mode='valid',
+                            dim_ordering=DIM_ORDERING))
+    model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999,
+                                 axis=bn_axis))
     model.add(Activation('relu'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
     print('Layer 5: ', model.layers[-1].output_shape)
 
-    # model.add(Convolution2D(96, 3, 3,
-    #                         # init='normal',
-    #                         border_mode='valid'))
-    # model.add(BatchNormalization(epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(Activation('relu'))
-    # print('Layer 6: ', model.layers[-1].output_shape)
-
-    # Flatten + FC layers.
+    # Flatten + FC layers. Dropout is folded into the Dense layers (see
+    # DenseDropout) instead of standing alone between them.
     model.add(Flatten())
-    # model.add(Dense(1000))
-    # model.add(Activation('relu'))
-    model.add(Dropout(0.5))
-
-    # model.add(Dense(1000, W_regularizer=l2(L2_WEIGHT)))
-    # # model.add(BatchNormalization(mode=1, epsilon=BN_EPSILON, momentum=0.999))
-    # # model.add(Activation('relu'))
-    # # model.add(keras.layers.advanced_activations.ELU(alpha=1.0))
-    # model.add(keras.layers.advanced_activations.PReLU())
-
-    model.add(Dense(100, W_regularizer=l2(L2_WEIGHT)))
-    # model.add(BatchNormalization(mode=1, epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(Activation('relu'))
-    # model.add(keras.layers.advanced_activations.ELU(alpha=1.0))
-    model.add(keras.layers.advanced_activations.PReLU())
-    model.add(Dropout(0.5))
-
-    model.add(Dense(50, W_regularizer=l2(L2_WEIGHT)))
-    # model.add(BatchNormalization(mode=1, epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(Activation('relu'))
-    # model.add(keras.layers.advanced_activations.ELU(alpha=1.0))
-    model.add(keras.layers.advanced_activations.PReLU())
-    # model.add(Dropout(0.5))
+
+    # Plain ReLU on the dense head: fuses with the preceding GEMM, with
+    # no per-unit alpha tensor to read (PReLU cost an extra elementwise
+    # kernel per layer).
+    model.add(DenseDropout(100, drop_rate=0.5))
+    model.add(Activation('relu'))
+
+    model.add(DenseDropout(50, drop_rate=0.5))
+    model.add(Activation('relu'))
 
     model.add(Dense(10))
-    # model.add(BatchNormalization(mode=1, epsilon=BN_EPSILON, momentum=0.999))
-    # model.add(Activation('relu'))
-    model.add(keras.layers.advanced_activations.PReLU())
-    # model.add(keras.layers.advanced_activations.ELU(alpha=1.0))
+    model.add(Activation('relu'))
 
     model.add(Dense(1))
     return model
 
 
+def fuse_bn_into_conv(model):
+    """Build an inference copy of the model with every BatchNormalization
+    folded into the preceding convolution.
+
+    In inference mode BN is the affine y = gamma * (x - mu) / sqrt(var+eps)
+    + beta, which folds into the convolution as w' = w * gamma / sqrt(var+eps)
+    and b' = beta + (b - mu) * gamma / sqrt(var+eps). The fused model runs
+    one less kernel (and one less memory pass) per conv block, and has no
+    BN left to deploy except a stand-alone input normalizer.
+
+    Params:
+      model: Trained Sequential model (cnn_model architecture).
+    Return:
+      New Sequential model with fused weights, ready to save for drive.py.
+    """
+    fused = Sequential()
+    layers = model.layers
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        next_layer = layers[i + 1] if i + 1 < len(layers) else None
+        if (isinstance(layer, Convolution2D) and
+                isinstance(next_layer, BatchNormalization)):
+            gamma, beta, mean, var = next_layer.get_weights()
+            scale = gamma / np.sqrt(var + next_layer.epsilon)
+            weights = layer.get_weights()
+            w = weights[0]
+            b = weights[1] if len(weights) > 1 else 0.
+            # Fused convolution: same config, with a bias this time.
+            config = layer.get_config()
+            config['bias'] = True
+            fused_layer = Convolution2D.from_config(config)
+            fused.add(fused_layer)
+            # Broadcast over the out-channel axis: last for 'tf' kernels
+            # (rows, cols, in, out), first for 'th' (out, in, rows, cols).
+            if layer.dim_ordering == 'th':
+                w = w * scale.reshape(-1, 1, 1, 1)
+            else:
+                w = w * scale
+            fused_layer.set_weights([w, beta + (b - mean) * scale])
+            i += 2
+        else:
+            new_layer = layer.__class__.from_config(layer.get_config())
+            fused.add(new_layer)
+            new_layer.set_weights(layer.get_weights())
+            i += 1
+    return fused
+
+
+def to_multi_gpu(model, nb_gpus):
+    """Data-parallel wrapper: replicate the model over local GPUs.
+
+    Each GPU tower runs the forward/backward pass on a slice of the
+    batch; the outputs are concatenated on the parameter device, so
+    gradient averaging happens where the variables live. Weights are
+    shared with the wrapped model, which stays the one to save.
+
+    Params:
+      model: Model to replicate.
+      nb_gpus: Number of towers.
+    Return:
+      Keras model consuming nb_gpus-times larger batches.
+    """
+    import tensorflow as tf
+
+    def slice_batch(x, n_gpus, part):
+        n = K.shape(x)[0]
+        if part == n_gpus - 1:
+            return x[part * n // n_gpus:]
+        return x[part * n // n_gpus:(part + 1) * n // n_gpus]
+
+    with tf.device('/cpu:0'):
+        x = Input(model.input_shape[1:])
+    towers = []
+    for g in range(nb_gpus):
+        with tf.device('/gpu:%d' % g):
+            slice_g = Lambda(slice_batch, lambda s: s,
+                             arguments={'n_gpus': nb_gpus, 'part': g})(x)
+            towers.append(model(slice_g))
+    with tf.device('/cpu:0'):
+        merged = merge(towers, mode='concat', concat_axis=0)
+    return Model(input=[x], output=merged)
+
+
+class WeightDecayAdam(keras.optimizers.Adam):
+    """Adam applying the L2 penalty directly inside the gradients.
+
+    Per-layer l2(L2_WEIGHT) regularizers each add a square + sum-reduce
+    op to the loss graph, one pair per weight tensor per step. The
+    gradient of lambda * ||w||^2 is just 2 * lambda * w, so adding that
+    term here is mathematically identical while folding into the
+    gradient tensors the optimizer reads anyway. Only decays weight
+    matrices/kernels (ndim > 1): biases and BN scales stay unpenalized.
+    Slightly wider scope than the old per-layer regularizers, which left
+    the small Dense(10) / Dense(1) kernels out.
+
+    When the loss is scaled (fp16 training), the gradients carry the
+    scale factor, so the caller must scale weight_decay to match.
+    """
+    def __init__(self, weight_decay=0., **kwargs):
+        super(WeightDecayAdam, self).__init__(**kwargs)
+        self.weight_decay = weight_decay
+
+    def get_gradients(self, loss, params):
+        grads = super(WeightDecayAdam, self).get_gradients(loss, params)
+        if self.weight_decay > 0.:
+            grads = [g + self.weight_decay * p if K.ndim(p) > 1 else g
+                     for g, p in zip(grads, params)]
+        return grads
+
+    def get_config(self):
+        config = super(WeightDecayAdam, self).get_config()
+        config['weight_decay'] = self.weight_decay
+        return config
+
+
 def train_model(X_train, y_train, X_test, y_test, ckpt_path='./'):
     """Train the Convolutional Model described by cnn_model.
     Params:
@@ -295,44 +550,84 @@ def train_model(X_train, y_train, X_test, y_test, ckpt_path='./'):
     print(X_test.shape[0], 'test samples')
     print('X_train shape:', X_train.shape)
 
-    # Training weights: more on large angles.
-    y_weights = np.ones_like(y_train) + ANGLE_WEIGHT * np.abs(y_train)
+    # Training weights: more on large angles. In-place ops on a single
+    # float32 output buffer, no ones_like / abs temporaries and no
+    # float64 upcast in the sample_weight path.
+    y_weights = np.empty(y_train.shape, dtype=np.float32)
+    np.abs(y_train, out=y_weights)
+    y_weights *= ANGLE_WEIGHT
+    y_weights += 1.0
+
+    # XLA auto-clustering, installed before any part of the graph is
+    # built. ON_1 only clusters ops XLA considers profitable; drop the
+    # flag if the stride-1 3x3 convolutions regress.
+    if XLA_JIT and K._BACKEND == 'tensorflow':
+        import tensorflow as tf
+        import keras.backend.tensorflow_backend as KTF
+        config = tf.ConfigProto()
+        config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
+        KTF.set_session(tf.Session(config=config))
+
+    # Half-precision training? Keras 1 has no mixed-precision policy, so
+    # this runs the whole graph in fp16 with a scaled loss.
+    loss = 'mse'
+    if FLOATX != 'float32':
+        K.set_floatx(FLOATX)
+        loss = lambda y_true, y_pred: LOSS_SCALE * K.mean(
+            K.square(y_pred - y_true), axis=-1)
+
+    # Per-channel input statistics, computed once over the training set
+    # and baked into the input Lambda as constants.
+    stat_axes = (0, 2, 3) if DIM_ORDERING == 'th' else (0, 1, 2)
+    x_mean = X_train.mean(axis=stat_axes, dtype=np.float32)
+    x_std = X_train.std(axis=stat_axes, dtype=np.float32)
+    if DIM_ORDERING == 'th':
+        x_mean = x_mean.reshape(-1, 1, 1)
+        x_std = x_std.reshape(-1, 1, 1)
+    print('Input mean / std:', x_mean.ravel(), x_std.ravel())
 
     # CNN Model.
-    model = cnn_model(X_train.shape[1:])
+    model = cnn_model(X_train.shape[1:], mean=x_mean, std=x_std)
     # Fine tuning model?
     if FINE_TUNE:
         print('Fine tuning model:', FINE_TUNE)
         model.load_weights(FINE_TUNE)
 
+    # Data-parallel towers? Weights stay shared with `model`, which
+    # remains the one serialized below.
+    train_net = model
+    batch_size = BATCH_SIZE
+    learning_rate = LEARNING_RATE
+    if NB_GPUS > 1:
+        train_net = to_multi_gpu(model, NB_GPUS)
+        batch_size *= NB_GPUS
+        learning_rate *= NB_GPUS
+
     # Train the model using Adam.
     # optimizer = SGD(lr=LEARNING_RATE, decay=DECAY, momentum=0.9, nesterov=True)
     # optimizer = keras.optimizers.RMSprop(lr=LEARNING_RATE, decay=DECAY,
     #                                      rho=0.9, epsilon=1e-08)
-    optimizer = keras.optimizers.Adam(lr=LEARNING_RATE, decay=DECAY,
-                                      beta_1=0.9, beta_2=0.999, epsilon=1e-08)
-
-    model.compile(optimizer=optimizer,
-                  loss='mse',
-                  metrics=['mean_absolute_error'])
-
-    # Save model architecture.
+    weight_decay = 2 * L2_WEIGHT
+    if FLOATX != 'float32':
+        # The scaled loss scales every gradient by LOSS_SCALE; scale the
+        # decay term the same way so the effective decay is unchanged.
+        weight_decay *= LOSS_SCALE
+    optimizer = WeightDecayAdam(weight_decay=weight_decay,
+                                lr=learning_rate, decay=DECAY,
+                                beta_1=0.9, beta_2=0.999, epsilon=1e-08)
+
+    train_net.compile(optimizer=optimizer,
+                      loss=loss,
+                      metrics=['mean_absolute_error'])
+
+    # Save model architecture: one pretty-printed copy, one to_json call.
+    spec = json.loads(model.to_json())
     with open(ckpt_path + 'model.json', 'w') as f:
-        json.dump(model.to_json(), f)
-    with open(ckpt_path + 'model_read.json', 'w') as f:
-        json.dump(json.loads(model.to_json()), f,
-                  indent=4, separators=(',', ': '))
+        json.dump(spec, f, indent=4, separators=(',', ': '))
 
     # Pre-processing and realtime data augmentation.
     datagen = ImageDataGenerator(
-        featurewise_center=False,   # Input mean to 0 over dataset.
-        samplewise_center=False,    # Each sample mean to 0.
-        featurewise_std_normalization=False,  # Divide inputs by STD of the dataset.
-        samplewise_std_normalization=False,   # Divide each input by its STD.
-        zca_whitening=False,        # Apply ZCA whitening
-        rotation_range=0,           # Randomly rotate images.
-        width_shift_range=0.,       # Random shift (fraction of total width).
-        height_shift_range=0.,      # Random shift (fraction of total height).
         brightness_delta=BRIGHTNESS_DELTA,
         contrast_lower=CONTRAST_LOWER,
         contrast_upper=CONTRAST_UPPER,
@@ -340,11 +635,8 @@ def train_model(X_train, y_train, X_test, y_test, ckpt_path='./'):
         saturation_upper=SATURATION_UPPER,
         hue_delta=HUE_DELTA,
         horizontal_flip=True,       # Random horizontal flip.
-        vertical_flip=False)        # Random vertical flip.
-
-    # Compute quantities required for featurewise normalization.
-    # (std, mean, and principal components if ZCA whitening is applied)
-    # datagen.fit(X_train)
+        vertical_flip=False,        # Random vertical flip.
+        dim_ordering=DIM_ORDERING)
 
     # Fit the model with batches generated by datagen.flow()
     callbacks = [
@@ -352,31 +644,60 @@ def train_model(X_train, y_train, X_test, y_test, ckpt_path='./'):
                                     histogram_freq=0,
                                     write_graph=True,
                                     write_images=True),
-        keras.callbacks.ModelCheckpoint(ckpt_path + 'model.{epoch:03d}-{val_loss:.4f}.h5',
-                                        monitor='val_loss',
-                                        verbose=1,
-                                        save_best_only=True,
-                                        save_weights_only=True)
+        # Background-thread checkpoint writes: the h5py IO overlaps the
+        # first batches of the next epoch instead of stalling it.
+        AsyncModelCheckpoint(ckpt_path + 'model.{epoch:03d}-{val_loss:.4f}.h5',
+                             monitor='val_loss',
+                             verbose=1,
+                             save_best_only=True)
         # keras.callbacks.LearningRateScheduler(lamda:x x)
     ]
 
-    model.fit_generator(datagen.flow(X_train, y_train,
-                                     batch_size=BATCH_SIZE,
-                                     sample_weight=y_weights,
-                                     # save_to_dir='./img/',
-                                     # save_format='png',
-                                     shuffle=True),
-                        samples_per_epoch=X_train.shape[0],
+    if SHM_PREFETCH:
+        # Worker processes write augmented batches into shared-memory
+        # slots; only slot indices are pickled. Each worker runs its own
+        # seeded iterator, so fit_generator consumes a single generator.
+        flow_factory = lambda worker_id: datagen.flow(
+            X_train, y_train,
+            batch_size=batch_size,
+            sample_weight=y_weights,
+            shuffle=True, seed=SEED + worker_id,
+            drop_remainder=True)
+        generator = shm_flow(flow_factory,
+                             nb_worker=NB_WORKER,
+                             pool_size=MAX_Q_SIZE)
+        nb_worker, pickle_safe = 1, False
+    else:
+        generator = datagen.flow(X_train, y_train,
+                                 batch_size=batch_size,
+                                 sample_weight=y_weights,
+                                 # save_to_dir='./img/',
+                                 # save_format='png',
+                                 shuffle=True,
+                                 drop_remainder=True)
+        # Threads, not processes: the augmentation is now OpenCV / NumPy
+        # calls that release the GIL, so worker threads scale without
+        # pickling every batch (and the dataset reference) through IPC.
+        nb_worker, pickle_safe = NB_WORKER, False
+
+    # Keep the batch dimension static end to end: the generators drop the
+    # ragged tail batch, so XLA compiles (and cuDNN autotunes) a single
+    # batch shape instead of re-specializing for the remainder each epoch.
+    train_net.fit_generator(generator,
+                        samples_per_epoch=X_train.shape[0] // batch_size * batch_size,
                         nb_epoch=NB_EPOCHS,
                         verbose=1,
                         validation_data=(X_test, y_test),
                         callbacks=callbacks,
-                        max_q_size=50,
-                        nb_worker=16,
-                        pickle_safe=True)
+                        max_q_size=MAX_Q_SIZE,
+                        nb_worker=nb_worker,
+                        pickle_safe=pickle_safe)
 
     # Save model parameters.
     model.save(ckpt_path + 'model.h5')
+    # Inference twin for the simulator: BN folded into the convs, one
+    # less kernel per block (see fuse_bn_into_conv).
+    fuse_bn_into_conv(model).save(ckpt_path + 'model_folded.h5')
 
 
 def main():
@@ -394,6 +715,10 @@ def main():
     ckpt_path = './logs/'
     # Load dataset.
     (X_train, y_train, X_test, y_test) = load_npz(DATASETS, split=0.9)
+    if DIM_ORDERING == 'th':
+        # One-time transpose to contiguous NCHW.
+        X_train = np.ascontiguousarray(X_train.transpose(0, 3, 1, 2))
+        X_test = np.ascontiguousarray(X_test.transpose(0, 3, 1, 2))
     # Save hyper-parameters.
     save_hyperparameters(ckpt_path)
     # Train model.
@@ -0,0 +1,145 @@
+"""TensorRT deployment of the behavioral cloning CNN.
+
+The trained Keras model is exported once offline to ONNX (keras2onnx /
+tf2onnx) and built into an FP16 engine, either with:
+  trtexec --onnx=model.onnx --fp16 --saveEngine=model.trt --workspace=512
+or directly with this module:
+  python trt_engine.py model.onnx model.trt
+
+FP16 halves the weights and lets TensorRT fuse Conv+BN+ReLU blocks into
+single kernels, which removes most of the per-frame kernel launch overhead
+of the Keras predict path for this small model.
+"""
+import sys
+
+import numpy as np
+
+import tensorrt as trt
+import pycuda.autoinit
+import pycuda.driver as cuda
+
+TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+
+# Workspace size for the builder, in MB.
+WORKSPACE_MB = 512
+
+# INT8 calibration: frames taken from the clean-driving dataset.
+CALIB_DATASET = './data/q3_clean/dataset.npz'
+CALIB_NB_FRAMES = 1000
+CALIB_BATCH_SIZE = 60
+CALIB_CACHE = 'calib.cache'
+
+
+class TRTModel:
+    """Thin ``predict`` wrapper around a serialized TensorRT engine.
+
+    Host (page-locked) and device buffers for the input image and the
+    scalar steering output are allocated once at load time and reused on
+    every frame, so per-frame cost is one H2D copy, one enqueue and one
+    D2H copy on a private stream.
+    """
+    def __init__(self, engine_path):
+        with open(engine_path, 'rb') as f:
+            runtime = trt.Runtime(TRT_LOGGER)
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        self.stream = cuda.Stream()
+
+        # Pre-allocated, pinned host buffers + device buffers.
+        self.h_input = cuda.pagelocked_empty(
+            trt.volume(self.engine.get_binding_shape(0)), np.float32)
+        self.h_output = cuda.pagelocked_empty(
+            trt.volume(self.engine.get_binding_shape(1)), np.float32)
+        self.d_input = cuda.mem_alloc(self.h_input.nbytes)
+        self.d_output = cuda.mem_alloc(self.h_output.nbytes)
+        self.bindings = [int(self.d_input), int(self.d_output)]
+
+    def predict(self, x, batch_size=1):
+        """Same signature as Keras model.predict, for drive.py."""
+        np.copyto(self.h_input, x.ravel())
+        cuda.memcpy_htod_async(self.d_input, self.h_input, self.stream)
+        self.context.execute_async_v2(bindings=self.bindings,
+                                      stream_handle=self.stream.handle)
+        cuda.memcpy_dtoh_async(self.h_output, self.d_output, self.stream)
+        self.stream.synchronize()
+        return self.h_output[:1]
+
+
+class NpzMinMaxCalibrator(trt.IInt8MinMaxCalibrator):
+    """MinMax PTQ calibrator fed with preprocessed frames from a .npz dataset.
+
+    Loads the first CALIB_NB_FRAMES images, applies the same crop + cast
+    as drive.py (raw 0-255 values: the exported model normalizes inputs
+    itself) and hands them to TensorRT in batches of CALIB_BATCH_SIZE
+    through a single device buffer.
+    """
+    def __init__(self, dataset=CALIB_DATASET, cache_file=CALIB_CACHE):
+        super(NpzMinMaxCalibrator, self).__init__()
+        self.cache_file = cache_file
+        data = np.load(dataset)
+        images = data['images'][:CALIB_NB_FRAMES]
+        # Same pre-processing as drive.image_preprocessing.
+        if images.shape[1] > 105:
+            images = images[:, 55:, :, :]
+        self.images = images.astype(np.float32)
+        self.batch_size = CALIB_BATCH_SIZE
+        self.index = 0
+        self.d_input = cuda.mem_alloc(
+            self.batch_size * int(self.images[0].nbytes))
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_batch(self, names):
+        if self.index + self.batch_size > self.images.shape[0]:
+            return None
+        batch = np.ascontiguousarray(
+            self.images[self.index:self.index + self.batch_size])
+        cuda.memcpy_htod(self.d_input, batch)
+        self.index += self.batch_size
+        return [int(self.d_input)]
+
+    def read_calibration_cache(self):
+        try:
+            with open(self.cache_file, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def write_calibration_cache(self, cache):
+        with open(self.cache_file, 'wb') as f:
+            f.write(cache)
+
+
+def build_engine(onnx_path, engine_path, fp16=True, int8=False):
+    """Build a TensorRT engine from an ONNX export of the model."""
+    builder = trt.Builder(TRT_LOGGER)
+    network = builder.create_network(
+        1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, TRT_LOGGER)
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            for i in range(parser.num_errors):
+                print(parser.get_error(i))
+            raise RuntimeError('Failed to parse ONNX model: ' + onnx_path)
+
+    config = builder.create_builder_config()
+    config.max_workspace_size = WORKSPACE_MB << 20
+    if fp16 and builder.platform_has_fast_fp16:
+        config.set_flag(trt.BuilderFlag.FP16)
+    if int8 and builder.platform_has_fast_int8:
+        # Keep FP16 enabled alongside INT8 so TensorRT can fall back on
+        # layers where the INT8 kernel is slower (typically the small
+        # Dense tail of the network).
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.int8_calibrator = NpzMinMaxCalibrator()
+
+    engine = builder.build_serialized_network(network, config)
+    with open(engine_path, 'wb') as f:
+        f.write(engine)
+    print('Engine saved:', engine_path)
+
+
+if __name__ == '__main__':
+    build_engine(sys.argv[1], sys.argv[2],
+                 int8='--int8' in sys.argv[3:])